@@ -56,5 +56,5 @@ def action_attribution_windows() -> [str]:
 
 
 def number_of_ad_performance_threads() -> str:
-    """The number of threads used to download ad performance"""
+    """The number of threads used to download ad performance and account structure"""
     return '10'
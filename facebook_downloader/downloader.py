@@ -3,6 +3,8 @@ import errno
 import heapq
 import json
 import logging
+import os
+import random
 import re
 import sqlite3
 import sys
@@ -11,6 +13,8 @@ import time
 import timeit
 import traceback
 import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from functools import wraps
 from pathlib import Path
 from typing import Generator, List, Union
@@ -18,11 +22,38 @@ from typing import Generator, List, Union
 from facebook_business.adobjects import user, adaccount, adsinsights
 from facebook_business.adobjects.adreportrun import AdReportRun
 from facebook_business.api import FacebookAdsApi, FacebookRequestError
+from facebook_business.session import FacebookSession
 
 from facebook_downloader import config
 
+try:
+    # orjson is an optional, considerably faster drop-in for serializing the json columns
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, separators=(',', ':'))
+
 OUTPUT_FILE_VERSION = 'v2'
 
+# matches labels in the form of "{key=value}"
+_LABEL_RE = re.compile(r'\{([^=]+)=(.+)\}')
+
+# the FacebookAdsApi instances of the threads created by _request_executor
+_thread_api = threading.local()
+
+# error codes of rate limiting errors, e.g. "User request limit reached"
+# https://developers.facebook.com/docs/graph-api/overview/rate-limiting
+_RATE_LIMIT_ERROR_CODES = {17, 613, 80004}
+
+# directories that have already been created by ensure_data_directory
+_ensured_directories: typing.Set[Path] = set()
+
+# matches the numeric strings returned by the insights api, e.g. "12", "-0.5" or "1.2e-05"
+_NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
 
 def download_data():
     """Initializes the FacebookAdsAPI, retrieves the ad accounts and downloads the data"""
@@ -30,13 +61,13 @@ def download_data():
                         config.app_secret(),
                         config.access_token())
     ad_accounts = _get_ad_accounts()
-    target_accounts = list(filter(None, config.target_accounts().split(',')))
+    target_accounts = set(filter(None, (account_id.strip() for account_id in config.target_accounts().split(','))))
     if len(target_accounts) > 0:
         logging.info('the app can see %s accounts but the configuration specified only %s target accounts: %s',
-                     len(ad_accounts), len(target_accounts), ', '.join(target_accounts))
-        ad_accounts = [ad_account for ad_account in ad_accounts if ad_account['account_id'] in config.target_accounts()]
-        logging.info('after filtering %s accounts will be downloaded: %s', len(target_accounts),
-                     ', '.join(target_accounts))
+                     len(ad_accounts), len(target_accounts), ', '.join(sorted(target_accounts)))
+        ad_accounts = [ad_account for ad_account in ad_accounts if ad_account['account_id'] in target_accounts]
+        logging.info('after filtering %s accounts will be downloaded: %s', len(ad_accounts),
+                     ', '.join(ad_account['account_id'] for ad_account in ad_accounts))
     download_data_sets(ad_accounts)
 
 
@@ -61,18 +92,34 @@ def download_account_structure(ad_accounts: [adaccount.AdAccount]):
     db_name = Path('facebook-account-structure-{}.sqlite3'.format(OUTPUT_FILE_VERSION))
     filepath = ensure_data_directory(db_name)
 
-    with sqlite3.connect(str(filepath)) as con:
-        for ad_account in ad_accounts:
-            for row in download_account_structure_per_account(ad_account):
-                _upsert_account_structure(row, con)
+    with closing(_open_db(str(filepath))) as con:
+        _ensure_account_structure_schema(con)
+        n_threads = int(config.number_of_ad_performance_threads())
+        # accounts are downloaded concurrently, but only this thread writes to the database.
+        # the requests of all accounts share one pool, so that its threads can keep their
+        # connections alive, each account issues three of them at once
+        with _request_executor(n_threads) as request_executor, \
+                ThreadPoolExecutor(max_workers=max(1, n_threads // 3)) as executor:
+            # the generators only start running (and downloading) within the worker threads
+            futures = {executor.submit(list, download_account_structure_per_account(ad_account, request_executor))
+                       for ad_account in ad_accounts}
+            try:
+                for future in as_completed(futures):
+                    _upsert_account_structure(future.result(), con)
+                    # release the rows of the account
+                    futures.discard(future)
+            except BaseException:
+                # don't wait for the accounts that have not started yet before failing
+                for future in futures:
+                    future.cancel()
+                raise
+        con.execute("PRAGMA optimize")
 
 
-def _upsert_account_structure(campaign_data, con: sqlite3.Connection):
-    """Creates the campaign performance table if it does not exists and upserts the
-    campaign data afterwards
+def _ensure_account_structure_schema(con: sqlite3.Connection):
+    """Creates the account structure table if it does not exists
 
     Args:
-        campaign_data: A list of campaign information objects
         con: A sqlite database connection
 
     """
@@ -89,8 +136,20 @@ CREATE TABLE IF NOT EXISTS account_structure (
   attributes  JSON,
   PRIMARY KEY (ad_id)
 );""")
-    con.execute("INSERT OR REPLACE INTO account_structure VALUES (?,?,?,?,?,?,?,?,?)",
-                campaign_data)
+
+
+def _upsert_account_structure(rows: typing.Iterable[List], con: sqlite3.Connection):
+    """Upserts account structure rows into the account structure table within a single transaction
+
+    Args:
+        rows: An iterable of account structure rows
+        con: A sqlite database connection in autocommit mode
+
+    """
+    with con:
+        con.execute("BEGIN")
+        con.executemany("INSERT OR REPLACE INTO account_structure VALUES (?,?,?,?,?,?,?,?,?)",
+                        rows)
 
 
 def download_ad_performance(ad_accounts: [adaccount.AdAccount]):
@@ -104,9 +163,9 @@ def download_ad_performance(ad_accounts: [adaccount.AdAccount]):
     contention if you specify a crazy amount of threads and your downloads finish
     quite fast. I however did not find a need to let threads grab a whole chunk of
     jobs at once, especially since jobs can be re-added to the queue. If a job
-    fails it will be added to a retry queue (sorted by retry_date ascending), a
-    single thread will pop this queue after waiting the specified amount of time
-    and will re-add the job back into to job queue. Due to the aforementioned
+    fails it will be added to a retry queue (sorted by retry_date ascending). Before
+    picking a job, threads move all jobs whose retry date has passed back into the
+    job queue, idle threads wait until the next retry date. Due to the aforementioned
     ordering of this queue failed jobs get increasing priority over other jobs
     based on their try_count.
 
@@ -120,45 +179,71 @@ def download_ad_performance(ad_accounts: [adaccount.AdAccount]):
 
     """
     job_list: List[JobQueueItem] = list()
+    redownload_window = int(config.redownload_window())
+    config_first_date = datetime.datetime.strptime(config.first_date(), '%Y-%m-%d').date()
+    # names of the files per day directory, so that each directory is only listed once for all accounts
+    file_names_per_directory: typing.Dict[Path, typing.Set[str]] = {}
     for ad_account in ad_accounts:
         # calculate yesterday based on the timezone of the ad account
         ad_account_timezone = datetime.timezone(datetime.timedelta(
             hours=float(ad_account['timezone_offset_hours_utc'])))
         last_date = datetime.datetime.now(ad_account_timezone).date() - datetime.timedelta(days=1)
-        first_date = _first_download_date_of_ad_account(ad_account)
+        first_date = _first_download_date_of_ad_account(ad_account, config_first_date)
+        account_id = ad_account['account_id']
 
-        # check for ad performance db on the first day the account
-        current_date = last_date
-        while current_date >= first_date:
+        # check for ad performance db on the first day the account,
+        # days_ago is the number of days between current_date and last_date
+        for days_ago in range((last_date - first_date).days + 1):
+            current_date = last_date - datetime.timedelta(days=days_ago)
             db_name = ensure_data_directory(
                 Path("{date:%Y/%m/%d}/facebook/ad-performance-act-{account_id}-{output_file_version}.sqlite3"
                      .format(date=current_date,
                              output_file_version=OUTPUT_FILE_VERSION,
-                             account_id=ad_account['account_id'])))
+                             account_id=account_id)))
 
-            if (not db_name.is_file()
-                    or (last_date - current_date).days <= int(config.redownload_window())):
-                job_list.append(JobQueueItem(ad_account['account_id'], current_date, str(db_name)))
-            current_date -= datetime.timedelta(days=1)
+            if days_ago > redownload_window:
+                directory = db_name.parent
+                if directory not in file_names_per_directory:
+                    file_names_per_directory[directory] = _file_names(directory)
+                if db_name.name in file_names_per_directory[directory]:
+                    continue
+            job_list.append(JobQueueItem(account_id, current_date, str(db_name)))
 
     _process_single_day_jobs_concurrently(job_list, int(config.number_of_ad_performance_threads()))
 
 
-def download_account_structure_per_account(ad_account: adaccount.AdAccount) \
+def download_account_structure_per_account(ad_account: adaccount.AdAccount,
+                                           request_executor: ThreadPoolExecutor = None) \
         -> Generator[List, None, None]:
     """Downloads the Facebook Ads account structure for a specific account
     and transforms them to flat rows per ad
 
     Args:
         ad_account: An ad account to download.
+        request_executor: An executor created by _request_executor that runs the
+                          requests, by default one is created for this account only
 
     Returns:
         An iterator of campaign structure rows
 
     """
-    campaign_data = get_campaign_data(ad_account)
-    ad_set_data = get_ad_set_data(ad_account)
-    ad_data = get_ad_data(ad_account)
+    own_request_executor = request_executor is None
+    if own_request_executor:
+        request_executor = _request_executor(min(3, int(config.number_of_ad_performance_threads())))
+    try:
+        # the three requests are independent of each other, so issue them concurrently
+        campaign_data_future = request_executor.submit(_call_with_thread_api, get_campaign_data, ad_account)
+        ad_set_data_future = request_executor.submit(_call_with_thread_api, get_ad_set_data, ad_account)
+        ad_data_future = request_executor.submit(_call_with_thread_api, get_ad_data, ad_account)
+        campaign_data = campaign_data_future.result()
+        ad_set_data = ad_set_data_future.result()
+        ad_data = ad_data_future.result()
+    finally:
+        if own_request_executor:
+            request_executor.shutdown()
+
+    # campaign attributes merged with the attributes of the ad set, by ad set id
+    ad_set_attributes = {}
 
     for ad_id, ad in ad_data.items():
         ad_set_id = ad['ad_set_id']
@@ -166,8 +251,11 @@ def download_account_structure_per_account(ad_account: adaccount.AdAccount) \
         campaign_id = ad_set['campaign_id']
         campaign = campaign_data[campaign_id]
 
-        attributes = {**campaign['attributes'],
-                      **ad_set['attributes'],
+        if ad_set_id not in ad_set_attributes:
+            ad_set_attributes[ad_set_id] = {**campaign['attributes'],
+                                            **ad_set['attributes']}
+
+        attributes = {**ad_set_attributes[ad_set_id],
                       **ad['attributes']}
 
         row = [ad_id,
@@ -178,11 +266,51 @@ def download_account_structure_per_account(ad_account: adaccount.AdAccount) \
                campaign['name'],
                ad_account['account_id'],
                ad_account['name'],
-               json.dumps(attributes)]
+               _json_dumps(attributes)]
 
         yield row
 
 
+def _request_executor(n_threads: int) -> ThreadPoolExecutor:
+    """Creates a thread pool for api requests in which every thread has its own
+    FacebookAdsApi instance, see _call_with_thread_api
+
+    Args:
+        n_threads: The number of threads
+
+    Returns:
+        A thread pool executor
+
+    """
+    return ThreadPoolExecutor(max_workers=n_threads, initializer=_init_thread_api)
+
+
+def _init_thread_api() -> None:
+    # Api objects do not seem thread safe at all, create one per thread and don't touch the
+    # default api either. The api is reused for all requests of the thread, so that the
+    # connections of its session are kept alive.
+    _thread_api.api = FacebookAdsApi(FacebookSession(config.app_id(),
+                                                     config.app_secret(),
+                                                     config.access_token()))
+
+
+def _call_with_thread_api(func: typing.Callable[[adaccount.AdAccount], typing.Any],
+                          ad_account: adaccount.AdAccount) -> typing.Any:
+    """Calls a function with a copy of the ad account that is bound to the api of the
+    current thread of a pool created by _request_executor
+
+    Args:
+        func: A function that makes requests for an ad account
+        ad_account: An ad account
+
+    Returns:
+        The result of the function
+
+    """
+    return func(adaccount.AdAccount.create_object(_thread_api.api, ad_account.export_all_data(),
+                                                  adaccount.AdAccount))
+
+
 def rate_limiting(func):
     """Wraps the function and applies an exponentially increasing sleep time
     if a rate limiting error occurs
@@ -204,7 +332,7 @@ def rate_limiting(func):
                 return func(*args, **kwargs)
             except FacebookRequestError as e:
                 if number_of_attempts < 7:
-                    duration = 60 * 2 ** number_of_attempts
+                    duration = _retry_duration(e, number_of_attempts)
                     logging.warning(e.get_message())
                     logging.warning(e.api_error_message())
                     logging.info('Retry #{attempt} in {duration} seconds'.format(attempt=number_of_attempts,
@@ -217,6 +345,48 @@ def rate_limiting(func):
     return func_wrapper
 
 
+def _retry_duration(error: FacebookRequestError, number_of_attempts: int) -> int:
+    """Computes the number of seconds to wait before retrying a failed request. The
+    exponential backoff is randomized, so that threads that hit the rate limit at the
+    same time do not all retry at the same time again. It is never shorter than the
+    time Facebook estimates until access is regained.
+
+    Args:
+        error: The error of the failed request
+        number_of_attempts: The number of previous retries of the request
+
+    Returns:
+        The number of seconds to wait
+
+    """
+    duration = min(3600, random.uniform(60, 60 * 3 ** (number_of_attempts + 1)))
+    return round(max(duration, _estimated_seconds_to_regain_access(error)))
+
+
+def _estimated_seconds_to_regain_access(error: FacebookRequestError) -> int:
+    """Reads the time until a rate limit is lifted from the business use case usage header
+
+    https://developers.facebook.com/docs/graph-api/overview/rate-limiting#headers
+
+    Args:
+        error: The error of the failed request
+
+    Returns:
+        The estimated number of seconds, 0 if unknown
+
+    """
+    usage = (error.http_headers() or {}).get('x-business-use-case-usage')
+    if not usage:
+        return 0
+    try:
+        # {business_id: [{'type': 'ads_insights', 'estimated_time_to_regain_access': minutes, ...}]}
+        return 60 * max((int(use_case.get('estimated_time_to_regain_access') or 0)
+                         for use_cases in json.loads(usage).values()
+                         for use_case in use_cases), default=0)
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
 @rate_limiting
 def get_ad_data(ad_account: adaccount.AdAccount) -> {}:
     """Retrieves the ad data of the ad account as a dictionary
@@ -322,6 +492,7 @@ def get_account_ad_performance_for_single_day(ad_account: adaccount.AdAccount,
         A list containing dictionaries with the ad performance from the report
 
     """
+    date_str = single_date.isoformat()
     fields = ['date_start',
               'ad_id',
               'impressions',
@@ -336,8 +507,8 @@ def get_account_ad_performance_for_single_day(ad_account: adaccount.AdAccount,
               'breakdowns': ['impression_device'],
               'level': 'ad',
               'limit': 1000,
-              'time_range': {'since': single_date.strftime('%Y-%m-%d'),
-                             'until': single_date.strftime('%Y-%m-%d')},
+              'time_range': {'since': date_str,
+                             'until': date_str},
               # By default only ACTIVE campaigns get considered.
               'filtering': [{
                   'field': 'ad.effective_status',
@@ -356,13 +527,17 @@ def get_account_ad_performance_for_single_day(ad_account: adaccount.AdAccount,
     # https://developers.facebook.com/docs/marketing-api/asyncrequests/
     async_job = ad_account.get_insights(fields=fields, params=params, is_async=True)
     async_job.api_get()
+    # every poll counts against the rate limit, so poll less often the longer the report takes
+    poll_interval = 1.0
     while async_job[AdReportRun.Field.async_percent_completion] < 100 or async_job[
         AdReportRun.Field.async_status] != 'Job Completed':
-        time.sleep(1)
+        time.sleep(poll_interval + random.uniform(0, poll_interval * 0.25))
+        poll_interval = min(30.0, poll_interval * 1.5)
         async_job.api_get()
     time.sleep(1)
 
-    ad_insights = async_job.get_result()
+    # the result of a report run is paginated independently of the limit of the job itself
+    ad_insights = async_job.get_result(params={'limit': 1000})
 
     return ad_insights
 
@@ -382,18 +557,30 @@ def ensure_data_directory(relative_path: Path = None) -> Path:
     try:
         path = Path(config.data_dir(), relative_path)
         # if path points to a file, create parent directory instead
-        if path.suffix:
-            if not path.parent.exists():
-                path.parent.mkdir(exist_ok=True, parents=True)
-        else:
-            if not path.exists():
-                path.mkdir(exist_ok=True, parents=True)
+        directory = path.parent if path.suffix else path
+        if directory not in _ensured_directories:
+            directory.mkdir(exist_ok=True, parents=True)
+            _ensured_directories.add(directory)
         return path
     except OSError as exception:
         if exception.errno != errno.EEXIST:
             raise
 
 
+def _file_names(directory: Path) -> typing.Set[str]:
+    """Lists the names of the files in a directory
+
+    Args:
+        directory: A Path object pointing to an existing directory
+
+    Returns:
+        A set of file names
+
+    """
+    with os.scandir(str(directory)) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+
 def parse_labels(labels: [{}]) -> {str: str}:
     """Extracts labels from a string.
 
@@ -408,9 +595,9 @@ def parse_labels(labels: [{}]) -> {str: str}:
     """
     labels_dict = {}
     for label in labels:
-        match = re.search("{([^=]+)=(.+)}", label['name'])
+        match = _LABEL_RE.search(label['name'])
         if match:
-            key = match.group(1).strip().lower().title()
+            key = match.group(1).strip().title()
             value = match.group(2).strip()
             labels_dict[key] = value
     return labels_dict
@@ -433,13 +620,31 @@ def _get_ad_accounts() -> [adaccount.AdAccount]:
     return list(ad_accounts)
 
 
-@rate_limiting
-def _upsert_ad_performance(ad_insights: [adsinsights.AdsInsights], con: sqlite3.Connection):
-    """Creates the ad performance table if it does not exists and upserts the
-    ad insights data afterwards
+def _open_db(db_name: str) -> sqlite3.Connection:
+    """Opens a sqlite database connection that is tuned for bulk writes. The
+    connection is in autocommit mode, so transactions have to be started explicitly.
+
+    Args:
+        db_name: The path of the sqlite database file
+
+    Returns:
+        A sqlite database connection
+
+    """
+    con = sqlite3.connect(db_name, isolation_level=None)
+    # with the default rollback journal, NORMAL saves one of the two syncs of the journal
+    # per commit (the one after writing its header), the database file is still synced
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    # 64 MiB page cache
+    con.execute("PRAGMA cache_size=-65536")
+    return con
+
+
+def _ensure_ad_performance_schema(con: sqlite3.Connection):
+    """Creates the ad performance table if it does not exists
 
     Args:
-        ad_insights: A list of Insights objects
         con: A sqlite database connection
 
     """
@@ -451,11 +656,24 @@ CREATE TABLE IF NOT EXISTS ad_performance (
   performance   TEXT   NOT NULL,
   PRIMARY KEY (ad_id, device)
 );""")
-    con.executemany("INSERT OR REPLACE INTO ad_performance VALUES (?,?,?,?)",
-                    _to_insight_row_tuples(ad_insights))
 
 
-@rate_limiting
+def _upsert_ad_performance(ad_insights: [adsinsights.AdsInsights], con: sqlite3.Connection):
+    """Creates the ad performance table if it does not exists and upserts the
+    ad insights data afterwards, both within a single transaction
+
+    Args:
+        ad_insights: A list of Insights objects
+        con: A sqlite database connection in autocommit mode
+
+    """
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        _ensure_ad_performance_schema(con)
+        con.executemany("INSERT OR REPLACE INTO ad_performance VALUES (?,?,?,?)",
+                        _to_insight_row_tuples(ad_insights))
+
+
 def _to_insight_row_tuples(ad_insights: [adsinsights.AdsInsights]) -> Generator[tuple, None, None]:
     """Transforms the Insights objects into tuples that can be directly inserted
     into the ad_performance table
@@ -467,60 +685,55 @@ def _to_insight_row_tuples(ad_insights: [adsinsights.AdsInsights]) -> Generator[
         A list of tuples of ad performance data
 
     """
-
-    @rate_limiting
-    def get_ad_insight(field, ad_insight, default_value=[]):
-        return ad_insight.get(field) or default_value
-
     for ad_insight in ad_insights:
-        actions = get_ad_insight('actions', ad_insight)
+        actions = ad_insight.get('actions')
+        if actions:
+            actions = [_floatify_values(action) for action in actions]
 
-        actions = [_floatify_values(action) for action in actions]
+        action_values = ad_insight.get('action_values')
+        if action_values:
+            action_values = [_floatify_values(action_value) for action_value in action_values]
 
-        action_values = get_ad_insight('action_values', ad_insight)
-        action_values = [_floatify_values(action_value) for action_value in action_values]
+        performance = {'impressions': int(ad_insight.get('impressions') or 0),
+                       'spend': float(ad_insight.get('spend') or 0.0),
+                       'actions': actions or [],
+                       'action_values': action_values or []}
 
-        impressions = get_ad_insight('impressions', ad_insight, 0)
-        spend = get_ad_insight('spend', ad_insight, 0.0)
-
-        performance = {'impressions': int(impressions),
-                       'spend': float(spend),
-                       'actions': actions,
-                       'action_values': action_values}
-
-        ad_insight_tuple = (ad_insight['date_start'],
-                            ad_insight['ad_id'],
-                            get_ad_insight('impression_device', ad_insight, 'Unknown'),
-                            json.dumps(performance))
-
-        yield ad_insight_tuple
+        yield (ad_insight['date_start'],
+               ad_insight['ad_id'],
+               ad_insight.get('impression_device') or 'Unknown',
+               _json_dumps(performance))
 
 
 def _floatify(value: str) -> Union[str, float]:
-    try:
+    # avoids raising (and catching) a ValueError for every non numeric value
+    if isinstance(value, str) and _NUMBER_RE.fullmatch(value):
         return float(value)
-    except ValueError:
-        return value
+    return value
 
 
 def _floatify_values(inp: {}) -> {}:
-    return {key: _floatify(value) for key, value in inp.items()}
+    result = {}
+    for key, value in inp.items():
+        # the action type is always a string, no need to check whether it is a number
+        result[key] = value if key == 'action_type' else _floatify(value)
+    return result
 
 
-def _first_download_date_of_ad_account(ad_account: adaccount.AdAccount) -> datetime.date:
+def _first_download_date_of_ad_account(ad_account: adaccount.AdAccount,
+                                       config_first_date: datetime.date) -> datetime.date:
     """Finds the first date for which the ad account's performance should be
     downloaded by comparing the first download date from the configuration and
     the creation date of the account and returning the maximum of the two.
 
     Args:
         ad_account: An ad account to download
+        config_first_date: The parsed first download date from the configuration
 
     Returns:
         The first date to download the performance data for
 
     """
-    config_first_date = datetime.datetime.strptime(config.first_date(),
-                                                   '%Y-%m-%d').date()
     if 'created_time' in ad_account:
         account_created_date = datetime.datetime.strptime(ad_account['created_time'],
                                                           "%Y-%m-%dT%H:%M:%S%z").date()
@@ -538,50 +751,37 @@ class JobQueueItem:
         self.db_name = db_name
         self.try_count: int = 0
 
-    def __lt__(self: 'JobQueueItem', other: 'JobQueueItem') -> bool:
-        # python heapq sorts lowest to highest
 
-        if self.try_count > other.try_count:
-            return True
-        elif self.try_count < other.try_count:
-            return False
+# The queues are heaps of tuples, so that heapq compares them in C rather than calling
+# a python __lt__. The id of the job breaks ties without ever comparing the jobs themselves.
+# (-try_count, -date ordinal, id, job)
+JobQueueEntry = typing.Tuple[int, int, int, JobQueueItem]
+# (retry_at, id, job)
+RetryQueueEntry = typing.Tuple[datetime.datetime, int, JobQueueItem]
 
-        if self.date > other.date:
-            return True
 
-        return False
-
-
-class RetryQueueItem:
-    def __init__(self: 'RetryQueueItem', retry_at: datetime.datetime, job: JobQueueItem) -> None:
-        self.retry_at: datetime.datetime = retry_at
-        self.job = job
-
-    def __lt__(self: 'RetryQueueItem', other: 'RetryQueueItem') -> bool:
-        return self.retry_at < other.retry_at
+def _job_queue_entry(job: JobQueueItem) -> JobQueueEntry:
+    # python heapq sorts lowest to highest, higher try counts and later dates go first
+    return -job.try_count, -job.date.toordinal(), id(job), job
 
 
 class ThreadArgs:
 
-    def __init__(self: 'ThreadArgs', job_list: typing.List[JobQueueItem]) -> None:
-        self.job_list: typing.List[JobQueueItem] = job_list
-        self.retry_queue: typing.List[RetryQueueItem] = list()
+    def __init__(self: 'ThreadArgs', job_list: typing.List[JobQueueEntry]) -> None:
+        self.job_list: typing.List[JobQueueEntry] = job_list
+        self.retry_queue: typing.List[RetryQueueEntry] = list()
         self.jobs_left = len(job_list)
         self.job_thread_done = False
-        self.retry_thread_done = False
 
         # job_list_cv protects:
         # - job_list
+        # - retry_queue
         # - job_thread_done
         self.job_list_cv: threading.Condition = threading.Condition()
         # state_changed_cv protects:
         # - error_occured
         # - jobs_left
         self.state_changed_cv: threading.Condition = threading.Condition()
-        # retry_queue_cv protects:
-        # - retry_queue
-        # - retry_thread_done
-        self.retry_queue_cv: threading.Condition = threading.Condition()
         self.logging_mutex: threading.Lock = threading.Lock()
         self.error_occured: bool = False
 
@@ -589,15 +789,15 @@ class ThreadArgs:
 def _process_single_day_jobs_concurrently(job_list: typing.List[JobQueueItem], n_threads: int) -> None:
     if n_threads < 1:
         raise ValueError('_process_single_day_jobs_concurrently should have n_threads > 0')
-    heapq.heapify(job_list)
-    thread_args: ThreadArgs = ThreadArgs(job_list)
+    # threads without a job would just wait until all the others are done
+    n_threads = min(n_threads, len(job_list)) or 1
+    job_queue: typing.List[JobQueueEntry] = [_job_queue_entry(job) for job in job_list]
+    heapq.heapify(job_queue)
+    thread_args: ThreadArgs = ThreadArgs(job_queue)
     # store the default API since the worker threads will change it
     default_api: FacebookAdsApi = FacebookAdsApi.get_default_api()
 
     thread_list: typing.List[threading.Thread] = list()
-    thread: threading.Thread = threading.Thread(target=_retry_thread_func, args=(thread_args,))
-    thread_list.append(thread)
-    thread.start()
     for i in range(0, n_threads):
         thread = threading.Thread(target=_job_thread_func, args=(thread_args,))
         thread_list.append(thread)
@@ -614,13 +814,10 @@ def _process_single_day_jobs_concurrently(job_list: typing.List[JobQueueItem], n
         # notify all waiting threads, so they can see that they are done
         # release -> aquire ordering matters due to potential deadlocking
         # use a second variable to identify a done variable
-        # that requires only a single lock rather than all three
+        # that requires only a single lock rather than both
         with thread_args.job_list_cv:
             thread_args.job_thread_done = True
             thread_args.job_list_cv.notify_all()
-        with thread_args.retry_queue_cv:
-            thread_args.retry_thread_done = True
-            thread_args.retry_queue_cv.notify()
 
     with thread_args.logging_mutex:
         logging.info('waiting for all threads to exit'.format(threading.get_ident()))
@@ -642,23 +839,30 @@ def _job_thread_func(args: ThreadArgs) -> None:
                                               config.app_secret(),
                                               config.access_token())
     FacebookAdsApi.set_default_api(None)
+    # ad account objects bound to this thread's api, by account id
+    ad_accounts: typing.Dict[str, adaccount.AdAccount] = {}
     with args.job_list_cv:
         while not args.job_thread_done:
+            _requeue_due_retries(args)
 
             if len(args.job_list) > 0:
-                job = heapq.heappop(args.job_list)
+                job = heapq.heappop(args.job_list)[-1]
                 args.job_list_cv.release()
-                _process_job(args, job, api)
+                _process_job(args, job, api, ad_accounts)
                 args.job_list_cv.acquire()
+            elif len(args.retry_queue) > 0:
+                # nothing to do until the next retry is due
+                args.job_list_cv.wait((args.retry_queue[0][0] - datetime.datetime.now()).total_seconds())
             else:
                 args.job_list_cv.wait()
 
     _log(logging.info, args.logging_mutex, ['thread {0} exited'.format(threading.get_ident())])
 
 
-def _process_job(args: ThreadArgs, job: JobQueueItem, api: FacebookAdsApi) -> None:
+def _process_job(args: ThreadArgs, job: JobQueueItem, api: FacebookAdsApi,
+                 ad_accounts: typing.Dict[str, adaccount.AdAccount]) -> None:
     account_id: str = job.ad_account_id
-    date_str: str = job.date.strftime('%Y-%m-%d')
+    date_str: str = job.date.isoformat()
     job.try_count += 1
     job_info_str: str = 'act_{ad_account_id} on {single_date}'.format(ad_account_id=account_id,
                                                                       single_date=date_str)
@@ -670,14 +874,24 @@ def _process_job(args: ThreadArgs, job: JobQueueItem, api: FacebookAdsApi) -> No
 
     request_error_occured: bool = False
     request_error_is_rate_limit: bool = False
+    retry_duration: int = 0
     error_occured: bool = False
     error_msg: typing.List[str] = list()
     ad_insights: adsinsights.AdsInsights
     try:
-        ad_account = adaccount.AdAccount('act_' + account_id, api=api)
+        ad_account = ad_accounts.get(account_id)
+        if ad_account is None:
+            ad_account = ad_accounts[account_id] = adaccount.AdAccount('act_' + account_id, api=api)
         ad_insights = get_account_ad_performance_for_single_day(ad_account, job.date)
-        with sqlite3.connect(job.db_name) as con:
-            _upsert_ad_performance(ad_insights, con)
+        db_existed = os.path.exists(job.db_name)
+        try:
+            with closing(_open_db(job.db_name)) as con:
+                _upsert_ad_performance(ad_insights, con)
+        except BaseException:
+            # the rollback also removes the table, and an existing file marks the day as downloaded
+            if not db_existed and os.path.exists(job.db_name):
+                os.remove(job.db_name)
+            raise
 
         end = timeit.default_timer()
 
@@ -693,8 +907,8 @@ def _process_job(args: ThreadArgs, job: JobQueueItem, api: FacebookAdsApi) -> No
 
     except FacebookRequestError as e:
         request_error_occured = True
-        # This is the error details of a rate limiting error. The message is "User request limit reached"
-        request_error_is_rate_limit = e.api_error_type() == 'OAuthException' and e.api_error_code() == 17
+        request_error_is_rate_limit = e.api_error_code() in _RATE_LIMIT_ERROR_CODES
+        retry_duration = _retry_duration(e, job.try_count - 1)
         error_msg.append(e.get_message())
         error_msg.append(e.api_error_message())
     except Exception as e:
@@ -703,21 +917,21 @@ def _process_job(args: ThreadArgs, job: JobQueueItem, api: FacebookAdsApi) -> No
 
     if request_error_occured:
         if job.try_count < 8:
-            duration: int = 60 * 2 ** (job.try_count - 1)
             retry_at: datetime.datetime = datetime.datetime.now() + datetime.timedelta(
-                seconds=duration)
+                seconds=retry_duration)
             retry_msg: str = 'retrying {job} in {duration} seconds - attempt #{attempt}'.format(
-                job=job_info_str, attempt=job.try_count, duration=duration)
+                job=job_info_str, attempt=job.try_count, duration=retry_duration)
             error_msg.append(retry_msg)
-            with args.retry_queue_cv:
-                heapq.heappush(args.retry_queue, RetryQueueItem(retry_at, job))
-                args.retry_queue_cv.notify_all()
+            with args.job_list_cv:
+                heapq.heappush(args.retry_queue, (retry_at, id(job), job))
+                # wake up idle threads, so that they wait for the new retry date
+                args.job_list_cv.notify_all()
             _log(logging.warning, args.logging_mutex, error_msg)
             if request_error_is_rate_limit:
                 # If the error was caused by rate limiting, sleep here to block the worker.
                 # Otherwise FB will keep being bombarded by uninterrupted requests constantly hitting the rate limit.
                 # Don't block execution otherwise (if it's not this particular error).
-                time.sleep(duration)
+                time.sleep(retry_duration)
             return
         else:
             error_occured = True
@@ -736,32 +950,13 @@ def _process_job(args: ThreadArgs, job: JobQueueItem, api: FacebookAdsApi) -> No
         return
 
 
-def _retry_thread_func(args: ThreadArgs) -> None:
-    # locking outside the main loop is fine here, since wait will relinquish the lock
-    with args.retry_queue_cv:
-        while not args.retry_thread_done:
-            wait_timeout: typing.Optional[float] = None
-            if len(args.retry_queue) > 0:
-                now: datetime.datetime = datetime.datetime.now()
-                top: typing.Optional[RetryQueueItem] = args.retry_queue[0]
-                # duplicate check, but this prevents mutex contention when it is not required
-                if (not top is None) and (now >= top.retry_at):
-                    # note: this will not deadlock since none of the other code locks
-                    # retry_queue_cv and job_list_cv nested in reverse order
-                    with args.job_list_cv:
-                        while (not top is None) and (now >= top.retry_at):
-                            current_job: JobQueueItem = heapq.heappop(args.retry_queue).job
-                            heapq.heappush(args.job_list, current_job)
-                            if len(args.retry_queue) > 0:
-                                top = args.retry_queue[0]
-                            else:
-                                top = None
-                        args.job_list_cv.notify()
-
-                if not top is None:
-                    wait_timeout = (top.retry_at - now).total_seconds()
-
-            args.retry_queue_cv.wait(wait_timeout)
+def _requeue_due_retries(args: ThreadArgs) -> None:
+    # must be called while holding job_list_cv
+    now: datetime.datetime = datetime.datetime.now()
+    while len(args.retry_queue) > 0 and args.retry_queue[0][0] <= now:
+        job: JobQueueItem = heapq.heappop(args.retry_queue)[-1]
+        # the try count changed since the job was queued, so the key is built anew
+        heapq.heappush(args.job_list, _job_queue_entry(job))
 
 
 def _log(log_func: typing.Callable[[str], None], logging_mutex: threading.Lock,
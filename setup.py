@@ -12,6 +12,10 @@ setup(
         'wheel>=0.29'
     ],
 
+    extras_require={
+        'orjson': ['orjson>=3.0']
+    },
+
     packages=find_packages(),
 
     author='Mara contributors',